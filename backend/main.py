@@ -1,24 +1,124 @@
+import asyncio
+import hashlib
+import logging
 import os
+import re
 import secrets
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
 from pathlib import Path
-from fastapi import FastAPI, Request, Depends, HTTPException, status
+from fastapi import FastAPI, Request, Depends, HTTPException, status, UploadFile, File
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import httpx
+import orjson
 
 load_dotenv()
 
-app = FastAPI(title="Radiology Transcription Tool")
+logger = logging.getLogger(__name__)
+
+FEEDBACK_DIR = Path(__file__).resolve().parent.parent / "feedback"
+FEEDBACK_FILE = FEEDBACK_DIR / "feedback.jsonl"
+# Entries waiting to be written; submit_feedback returns 503 once this many are backed up
+FEEDBACK_QUEUE_SIZE = 1000
+
+
+@dataclass(slots=True, frozen=True)
+class Config:
+    """Settings read from the environment once at import."""
+    openai_key: str
+    deepgram_key: str
+    # Credentials are kept only as SHA-256 digests so they compare in constant time at fixed length
+    auth_user_hash: bytes
+    auth_pass_hash: bytes
+    auth_configured: bool
+    maintenance: bool
+    openai_concurrency: int
+
+
+def _load_config() -> Config:
+    username = os.getenv("AUTH_USERNAME", "")
+    password = os.getenv("AUTH_PASSWORD", "")
+    openai_concurrency = int(os.getenv("OPENAI_CONCURRENCY", "16"))
+    if openai_concurrency < 1:
+        raise ValueError(f"OPENAI_CONCURRENCY must be at least 1, got {openai_concurrency}")
+    return Config(
+        openai_key=os.getenv("OPENAI_API_KEY", ""),
+        deepgram_key=os.getenv("DEEPGRAM_API_KEY", ""),
+        auth_user_hash=hashlib.sha256(username.encode()).digest(),
+        auth_pass_hash=hashlib.sha256(password.encode()).digest(),
+        auth_configured=bool(username and password),
+        maintenance=os.getenv("MAINTENANCE_MODE", "false").lower() == "true",
+        openai_concurrency=openai_concurrency,
+    )
+
+
+CFG = _load_config()
+if not CFG.openai_key:
+    logger.warning("OPENAI_API_KEY is not set; transcription and report endpoints will return 500")
+if not CFG.auth_configured:
+    logger.warning("AUTH_USERNAME/AUTH_PASSWORD are not set; all authenticated routes will reject requests")
+
+
+def _append_lines(path: Path, lines: list) -> None:
+    # One write per batch so appends from multiple workers don't interleave mid-line
+    with open(path, "ab") as f:
+        f.write(b"".join(lines))
+
+
+async def feedback_writer(app: FastAPI):
+    """Drain queued feedback lines and append them to disk in batches off the event loop."""
+    queue = app.state.fb_queue
+    while True:
+        entries = [await queue.get()]
+        while not queue.empty():
+            entries.append(queue.get_nowait())
+        # None is queued on shutdown to flush what's left and stop
+        done = None in entries
+        entries = [entry for entry in entries if entry is not None]
+        if entries:
+            try:
+                await asyncio.to_thread(_append_lines, FEEDBACK_FILE, entries)
+            except Exception:
+                # Drop the batch but keep the writer alive for later entries
+                logger.exception("Failed to write %d feedback entries", len(entries))
+        if done:
+            return
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Share one pooled HTTP client across requests to reuse upstream connections."""
+    app.state.http = httpx.AsyncClient(
+        timeout=httpx.Timeout(120.0),
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=100, keepalive_expiry=30.0),
+        http2=True,
+    )
+    app.state.openai_sem = asyncio.Semaphore(CFG.openai_concurrency)
+    FEEDBACK_DIR.mkdir(exist_ok=True)
+    app.state.fb_queue = asyncio.Queue(maxsize=FEEDBACK_QUEUE_SIZE)
+    writer = asyncio.create_task(feedback_writer(app))
+    yield
+    if not writer.done():
+        await app.state.fb_queue.put(None)
+    try:
+        await writer
+    except Exception:
+        logger.exception("Feedback writer exited with an error")
+    await app.state.http.aclose()
+
+
+app = FastAPI(title="Radiology Transcription Tool", lifespan=lifespan, default_response_class=ORJSONResponse)
 security = HTTPBasic()
 
-MAINTENANCE_MODE = os.getenv("MAINTENANCE_MODE", "false").lower() == "true"
-DEEPGRAM_API_KEY = os.getenv("DEEPGRAM_API_KEY")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-AUTH_USERNAME = os.getenv("AUTH_USERNAME", "")
-AUTH_PASSWORD = os.getenv("AUTH_PASSWORD", "")
+# Upstream request headers are fixed for the life of the process; handlers must not mutate these
+_OAI_AUTH = {"Authorization": f"Bearer {CFG.openai_key}"}
+_OAI_JSON = {**_OAI_AUTH, "Content-Type": "application/json"}
 
 REPORT_PROMPT = """You are a radiology report formatting assistant. Convert the following dictated transcription into a properly structured radiology report.
 
@@ -58,6 +158,81 @@ TRANSCRIPTION TO FORMAT:
 """
 
 
+# The chat request body is identical apart from the transcript, so serialize it once and splice
+_REPORT_BODY_HEAD, _REPORT_BODY_TAIL = orjson.dumps({
+    "model": "gpt-4o",
+    "messages": [
+        {"role": "system", "content": REPORT_PROMPT},
+        {"role": "user", "content": "__TRANSCRIPT__"}
+    ],
+    "temperature": 0.3,
+    "max_tokens": 2000,
+}).split(b'"__TRANSCRIPT__"')
+
+
+# Upstream statuses worth retrying with backoff
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+UPSTREAM_ATTEMPTS = 3
+# Longer Retry-After waits than this are passed back to the caller instead of held open
+MAX_RETRY_AFTER = 30.0
+
+
+def _retry_after(resp: httpx.Response) -> float | None:
+    """Seconds from a numeric Retry-After header, or None if absent or an HTTP date."""
+    try:
+        return max(float(resp.headers["Retry-After"]), 0.0)
+    except (KeyError, ValueError):
+        return None
+
+
+async def _post_openai(req: Request, url: str, **kwargs) -> httpx.Response:
+    """POST to OpenAI under the per-worker concurrency cap, backing off on rate limits and 5xx."""
+    delay = 0.5
+    for attempt in range(UPSTREAM_ATTEMPTS):
+        async with req.app.state.openai_sem:
+            resp = await req.app.state.http.post(url, **kwargs)
+        if resp.status_code not in _RETRY_STATUSES or attempt == UPSTREAM_ATTEMPTS - 1:
+            return resp
+        wait = _retry_after(resp)
+        if wait is None:
+            wait = delay
+        elif wait > MAX_RETRY_AFTER:
+            return resp
+        # Release the slot while waiting so other requests can proceed
+        await asyncio.sleep(wait)
+        delay = min(delay * 2, 8.0)
+
+
+# Recently generated reports keyed by normalized transcript, evicted least-recently-used first
+REPORT_CACHE_SIZE = 512
+_report_cache: "OrderedDict[bytes, str]" = OrderedDict()
+
+
+def _report_cache_key(transcript: str) -> bytes:
+    # surrogatepass so a lone surrogate (valid JSON, invalid UTF-8) still hashes instead of raising
+    return hashlib.blake2b(transcript.strip().lower().encode(errors="surrogatepass"), digest_size=16).digest()
+
+
+class _UploadReader:
+    """Read-only view of an upload without fileno(), so httpx sizes it via tell/seek.
+
+    Exposing fileno() would make httpx force a small SpooledTemporaryFile to roll over to disk.
+    """
+    __slots__ = ("_file",)
+
+    def __init__(self, file):
+        self._file = file
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+
 class ReportRequest(BaseModel):
     transcript: str
 
@@ -70,9 +245,11 @@ class FeedbackRequest(BaseModel):
 
 
 def verify_credentials(credentials: HTTPBasicCredentials = Depends(security)):
-    correct_username = secrets.compare_digest(credentials.username, AUTH_USERNAME)
-    correct_password = secrets.compare_digest(credentials.password, AUTH_PASSWORD)
-    if not (correct_username and correct_password):
+    u = hashlib.sha256(credentials.username.encode()).digest()
+    p = hashlib.sha256(credentials.password.encode()).digest()
+    # Bitwise & so both comparisons always run
+    ok = secrets.compare_digest(u, CFG.auth_user_hash) & secrets.compare_digest(p, CFG.auth_pass_hash)
+    if not ok or not CFG.auth_configured:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid credentials",
@@ -82,9 +259,14 @@ def verify_credentials(credentials: HTTPBasicCredentials = Depends(security)):
 
 
 static_dir = Path(__file__).parent.parent / "frontend"
+index_path = static_dir / "index.html"
 if static_dir.exists():
     app.mount("/static", StaticFiles(directory=str(static_dir)), name="static")
 
+# index.html is served from memory; restart the server to pick up edits
+_INDEX_BYTES = index_path.read_bytes() if index_path.exists() else None
+_INDEX_ETAG = f'"{hashlib.md5(_INDEX_BYTES).hexdigest()}"' if _INDEX_BYTES is not None else None
+
 
 @app.get("/health")
 async def health():
@@ -93,134 +275,143 @@ async def health():
 
 
 @app.get("/")
-async def root(username: str = Depends(verify_credentials)):
-    if MAINTENANCE_MODE:
+async def root(request: Request, username: str = Depends(verify_credentials)):
+    if CFG.maintenance:
         return {"message": "Coming soon - currently in private beta"}
-    index_path = static_dir / "index.html"
-    if index_path.exists():
-        return FileResponse(index_path)
+    if _INDEX_BYTES is not None:
+        headers = {"ETag": _INDEX_ETAG, "Cache-Control": "no-cache"}
+        if _INDEX_ETAG in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+        return Response(content=_INDEX_BYTES, media_type="text/html", headers=headers)
     return {"message": "Frontend not found"}
 
 
-from fastapi import UploadFile, File
-import tempfile
-
 @app.post("/api/transcribe-chunk")
-async def transcribe_chunk(audio: UploadFile = File(...), username: str = Depends(verify_credentials)):
+async def transcribe_chunk(req: Request, audio: UploadFile = File(...), username: str = Depends(verify_credentials)):
     """Transcribe an audio chunk using OpenAI Whisper API."""
-    if not OPENAI_API_KEY:
+    if not CFG.openai_key:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
     
-    # Save uploaded audio to temp file
-    suffix = ".webm"
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        content = await audio.read()
-        if len(content) < 1000:  # Too small, likely silence
-            return {"text": ""}
-        tmp.write(content)
-        tmp_path = tmp.name
+    # Stream the upload Starlette already spooled (in memory under 1 MB) straight into the multipart body
+    if (audio.size or 0) < 1000:  # Too small, likely silence
+        return {"text": ""}
     
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            with open(tmp_path, "rb") as f:
-                files = {"file": ("audio.webm", f, "audio/webm")}
-                data = {
-                    "model": "whisper-1",
-                    "language": "en",
-                    "prompt": "Radiology dictation with medical terminology: bilateral, inferior, superior, anterior, posterior, medial, lateral, proximal, distal, carcinoma, metastasis, lesion, nodule, opacity, effusion, atelectasis, consolidation, pneumothorax, cardiomegaly, hepatomegaly, splenomegaly."
-                }
-                
-                resp = await client.post(
-                    "https://api.openai.com/v1/audio/transcriptions",
-                    headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
-                    files=files,
-                    data=data,
-                )
-            
-            if resp.status_code != 200:
-                return {"text": "", "error": f"Whisper API error: {resp.status_code}"}
-            
-            result = resp.json()
-            text = result.get("text", "").strip()
-            
-            # Handle dictation commands
-            import re
-            # "new paragraph" or "new line" -> actual line breaks
-            text = re.sub(r'\b[Nn]ew [Pp]aragraph\b', '\n\n', text)
-            text = re.sub(r'\b[Nn]ew [Ll]ine\b', '\n', text)
-            
-            return {"text": text}
-    except Exception as e:
-        return {"text": "", "error": str(e)}
-    finally:
-        import os as os_module
-        os_module.unlink(tmp_path)
+        files = {"file": ("audio.webm", _UploadReader(audio.file), "audio/webm")}
+        data = {
+            "model": "whisper-1",
+            "language": "en",
+            "prompt": "Radiology dictation with medical terminology: bilateral, inferior, superior, anterior, posterior, medial, lateral, proximal, distal, carcinoma, metastasis, lesion, nodule, opacity, effusion, atelectasis, consolidation, pneumothorax, cardiomegaly, hepatomegaly, splenomegaly."
+        }
+        
+        resp = await _post_openai(
+            req,
+            "https://api.openai.com/v1/audio/transcriptions",
+            headers=_OAI_AUTH,
+            files=files,
+            data=data,
+            timeout=30.0,
+        )
+        
+        if resp.status_code != 200:
+            return {"text": "", "error": f"Whisper API error: {resp.status_code}"}
+        
+        result = resp.json()
+        text = result.get("text", "").strip()
+        
+        # Handle dictation commands
+        # "new paragraph" or "new line" -> actual line breaks
+        text = re.sub(r'\b[Nn]ew [Pp]aragraph\b', '\n\n', text)
+        text = re.sub(r'\b[Nn]ew [Ll]ine\b', '\n', text)
+        
+        return {"text": text}
+    except httpx.TimeoutException:
+        return {"text": "", "error": "Whisper request timed out"}
+    except (httpx.HTTPError, ValueError) as e:
+        logger.exception("Whisper transcription failed")
+        return {"text": "", "error": e.__class__.__name__}
 
 
 @app.post("/api/generate-report")
-async def generate_report(request: ReportRequest, username: str = Depends(verify_credentials)):
+async def generate_report(request: ReportRequest, req: Request, username: str = Depends(verify_credentials)):
     """Generate a formatted radiology report from transcription using LLM."""
-    if not OPENAI_API_KEY:
+    if not CFG.openai_key:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
     
     if not request.transcript.strip():
         raise HTTPException(status_code=400, detail="Transcript is empty")
     
+    # Encode up front, as submit_feedback does, so unencodable text is a 422 rather than a 500
+    try:
+        body = _REPORT_BODY_HEAD + orjson.dumps(request.transcript) + _REPORT_BODY_TAIL
+    except orjson.JSONEncodeError:
+        raise HTTPException(status_code=422, detail="Transcript contains invalid text")
+    
+    cache_key = _report_cache_key(request.transcript)
+    report = _report_cache.get(cache_key)
+    if report is not None:
+        _report_cache.move_to_end(cache_key)
+        return {
+            "report": report,
+            "format": "Standard Radiology Report (ACR Guidelines)",
+            "model": "gpt-4o"
+        }
+    
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            resp = await client.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {OPENAI_API_KEY}",
-                    "Content-Type": "application/json",
-                },
-                json={
-                    "model": "gpt-4o",
-                    "messages": [
-                        {"role": "system", "content": REPORT_PROMPT},
-                        {"role": "user", "content": request.transcript}
-                    ],
-                    "temperature": 0.3,
-                    "max_tokens": 2000,
-                },
-            )
-            
-            if resp.status_code != 200:
-                raise HTTPException(status_code=500, detail=f"OpenAI API error: {resp.text}")
-            
-            result = resp.json()
-            report = result["choices"][0]["message"]["content"]
-            
-            return {
-                "report": report,
-                "format": "Standard Radiology Report (ACR Guidelines)",
-                "model": "gpt-4o"
-            }
+        resp = await _post_openai(
+            req,
+            "https://api.openai.com/v1/chat/completions",
+            headers=_OAI_JSON,
+            content=body,
+            timeout=60.0,
+        )
+        
+        if resp.status_code != 200:
+            logger.warning("OpenAI API error %s: %s", resp.status_code, resp.text)
+            raise HTTPException(status_code=502, detail=f"OpenAI API error: {resp.status_code}")
+        
+        result = resp.json()
+        report = result["choices"][0]["message"]["content"]
+        
+        _report_cache[cache_key] = report
+        if len(_report_cache) > REPORT_CACHE_SIZE:
+            _report_cache.popitem(last=False)
+        
+        return {
+            "report": report,
+            "format": "Standard Radiology Report (ACR Guidelines)",
+            "model": "gpt-4o"
+        }
     except httpx.TimeoutException:
         raise HTTPException(status_code=504, detail="Request timed out")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    except httpx.HTTPError as e:
+        logger.exception("Report generation request failed")
+        raise HTTPException(status_code=502, detail=e.__class__.__name__)
+    except (KeyError, IndexError, ValueError):
+        logger.exception("Unexpected OpenAI response")
+        raise HTTPException(status_code=502, detail="Unexpected OpenAI response")
 
 
 @app.post("/api/feedback")
-async def submit_feedback(request: FeedbackRequest, username: str = Depends(verify_credentials)):
+async def submit_feedback(request: FeedbackRequest, req: Request, username: str = Depends(verify_credentials)):
     """Store user feedback on generated reports."""
-    import json
-    from datetime import datetime
-    
-    feedback_dir = Path(__file__).parent.parent / "feedback"
-    feedback_dir.mkdir(exist_ok=True)
-    
     feedback_entry = {
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
         "rating": request.rating,
         "comment": request.comment,
         "transcript": request.transcript[:500],  # Truncate for storage
         "report": request.report[:1000],  # Truncate for storage
     }
     
-    feedback_file = feedback_dir / "feedback.jsonl"
-    with open(feedback_file, "a") as f:
-        f.write(json.dumps(feedback_entry) + "\n")
+    # Encode here so an unencodable entry is rejected now rather than failing in the writer
+    try:
+        line = orjson.dumps(feedback_entry) + b"\n"
+    except orjson.JSONEncodeError:
+        raise HTTPException(status_code=422, detail="Feedback contains invalid text")
+    
+    try:
+        req.app.state.fb_queue.put_nowait(line)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Feedback storage is busy, please retry")
     
     return {"status": "ok"}
@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
-"""Start the transcription server."""
+"""Start the transcription server for production."""
+import os
+
 import uvicorn
 
 if __name__ == "__main__":
-    print("Starting Radiology Transcription Tool...")
-    print("Open http://localhost:8000 in your browser")
-    uvicorn.run("backend.main:app", host="0.0.0.0", port=8000, reload=True)
+    uvicorn.run(
+        "backend.main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", "4")),
+        loop="uvloop",
+        http="httptools",
+        access_log=False,
+    )